@@ -1,33 +1,103 @@
-from typing import Callable
-from threading import Timer
-
-from typing import Any, Callable
-from threading import Timer
-from functools import wraps
-
-
-def debounce(ms: int) -> Callable[..., Callable[..., None]]:
-    """Postpone a function's execution until after some time has elapsed.
-
-    :param ms: The amount of milliseconds to wait before the next call can execute.
-    :return: The debounced function.
-    """
-    wait_seconds = ms / 1000
-
-    def decorator(fun: Callable[..., None]) -> Callable[..., None]:
-        @wraps(fun)
-        def debounced(*args: Any, **kwargs: Any) -> None:
-            def call_it() -> None:
-                fun(*args, **kwargs)
-
-            try:
-                debounced.t.cancel()  # type: ignore
-            except AttributeError:
-                pass
-
-            debounced.t = Timer(wait_seconds, call_it)  # type: ignore
-            debounced.t.start()  # type: ignore
-
-        return debounced
-
-    return decorator  # type: ignore
+import time
+from typing import Any, Callable
+from threading import Event, Lock, Thread
+from functools import wraps
+
+
+class Debouncer:
+    """Debounce calls to `fun` through one long-lived worker thread.
+
+    The first call in a quiet period runs immediately on the caller's
+    thread (leading edge); calls that follow within `wait_seconds` are
+    coalesced into one trailing execution. Unlike a Timer-per-call design,
+    triggering only bumps a deadline — no thread is created per call, which
+    matters when the filesystem delivers thousands of events per second.
+    """
+
+    def __init__(
+        self,
+        fun: Callable[..., None],
+        wait_seconds: float,
+        max_seconds: float | None = None,
+    ):
+        self._fun = fun
+        self._wait = wait_seconds
+        self._max = max_seconds
+        self._lock = Lock()
+        self._event = Event()
+        self._deadline = 0.0
+        self._max_deadline: float | None = None
+        self._cooling_until = 0.0
+        self._pending: tuple[tuple, dict] | None = None
+        self._worker = Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def trigger(self, *args: Any, **kwargs: Any) -> None:
+        run_now = False
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._cooling_until and self._pending is None:
+                # leading edge: nothing recent and nothing pending
+                self._cooling_until = now + self._wait
+                run_now = True
+            else:
+                self._pending = (args, kwargs)
+                self._deadline = now + self._wait
+                if self._max is not None and self._max_deadline is None:
+                    self._max_deadline = now + self._max
+                self._event.set()
+        if run_now:
+            self._fun(*args, **kwargs)
+
+    def _run(self) -> None:
+        while True:
+            self._event.wait()
+            with self._lock:
+                deadline = self._deadline
+                if self._max_deadline is not None:
+                    deadline = min(deadline, self._max_deadline)
+                remaining = deadline - time.monotonic()
+            if remaining > 0:
+                # deadline may get bumped while we sleep; re-check after
+                time.sleep(remaining)
+                continue
+            with self._lock:
+                pending = self._pending
+                self._pending = None
+                self._max_deadline = None
+                self._event.clear()
+                self._cooling_until = time.monotonic() + self._wait
+            if pending is not None:
+                args, kwargs = pending
+                self._fun(*args, **kwargs)
+
+
+def debounce(
+    ms: int, max_ms: int | None = None
+) -> Callable[..., Callable[..., None]]:
+    """Run on the leading edge, then coalesce calls that follow.
+
+    The first call executes immediately, so a single event does not wait the
+    full debounce window. Calls arriving within the next `ms` are coalesced
+    into one trailing execution that fires `ms` after the last of them (or
+    after `max_ms` from the first suppressed call, when given, so a steady
+    stream of calls cannot postpone execution forever).
+
+    :param ms: The amount of milliseconds to wait before the next call can execute.
+    :param max_ms: Optional cap on how long a trailing execution may be postponed.
+    :return: The debounced function.
+    """
+    wait_seconds = ms / 1000
+    max_seconds = max_ms / 1000 if max_ms is not None else None
+
+    def decorator(fun: Callable[..., None]) -> Callable[..., None]:
+        debouncer = Debouncer(fun, wait_seconds, max_seconds)
+
+        @wraps(fun)
+        def debounced(*args: Any, **kwargs: Any) -> None:
+            debouncer.trigger(*args, **kwargs)
+
+        debounced.debouncer = debouncer  # type: ignore
+        return debounced
+
+    return decorator